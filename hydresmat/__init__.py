@@ -4,4 +4,5 @@ Matrix"""
 from hydresmat.calc import *
 from hydresmat.sim import *
 from hydresmat.io import *
+from hydresmat.brownian import *
 from hydresmat.common import print2
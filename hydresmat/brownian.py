@@ -0,0 +1,116 @@
+"""Diffusion and Brownian dynamics based on hydrodynamic resistance
+matrices."""
+
+""" Copyright (C) 2018-2019 Johannes Voss, Julian Jeggle, Raphael Wittkowski
+
+    This file is part of HydResMat.
+
+    HydResMat is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    HydResMat is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with HydResMat. If not, see <http://www.gnu.org/licenses/>."""
+
+
+import numpy as np
+import numpy.linalg as la
+
+__all__ = ["grand_resistance_matrix", "BrownianIncrements"]
+
+def grand_resistance_matrix(K, C, Omega):
+    """Assemble the hydrodynamic resistance matrix H={{K,C^T},{C,Omega}}.
+
+    All submatrices may also be given as stacks of shape (..., 3, 3), e.g. for
+    several particle shapes at once, in which case a stack of 6x6 matrices is
+    returned. Since the submatrices obtained by FEM simulations are only
+    approximately consistent, the result is symmetrized.
+
+    Parameters
+    ----------
+    K
+        Submatrix K (e.g. from `calc_submatrices` for "trans" data)
+    C
+        Submatrix C (e.g. from `calc_submatrices` for "trans" data or the
+        transpose of D from `calc_submatrices` for "rot" data)
+    Omega
+        Submatrix Omega (e.g. from `calc_submatrices` for "rot" data)
+    """
+    K = np.asarray(K, dtype=float)
+    C = np.asarray(C, dtype=float)
+    Omega = np.asarray(Omega, dtype=float)
+    H = np.concatenate([
+        np.concatenate([K, np.swapaxes(C, -1, -2)], axis=-1),
+        np.concatenate([C, Omega], axis=-1)], axis=-2)
+    return 0.5 * (H + np.swapaxes(H, -1, -2))
+
+class BrownianIncrements(object):
+    r"""Generator for correlated Brownian increments of rigid particles.
+
+    The mobility matrix M = H^-1, the diffusion tensor D = k_B T M and its
+    Cholesky factor L (D = L L^T) are calculated once when creating the
+    object. Calling the object then yields the random translational and
+    rotational displacements sqrt(2 dt) L xi, with xi being standard normally
+    distributed, for a whole batch of particles at once. All quantities refer
+    to the particle frame and to the point of reference used in the FEM
+    simulations.
+
+    The submatrices may also be given as stacks of shape (m, 3, 3) (or any
+    other leading shape), e.g. for m different particle shapes. The increments
+    are then generated for n particles of each shape.
+
+    Parameters
+    ----------
+    K, C, Omega
+        Submatrices of the hydrodynamic resistance matrix (see
+        `grand_resistance_matrix`)
+    kT: float, optional
+        Thermal energy k_B T
+    viscosity: float, optional
+        Viscosity of the fluid. The FEM simulations are carried out for unit
+        viscosity, so the resistance matrix is scaled by this value.
+    """
+    def __init__(self, K, C, Omega, kT=1.0, viscosity=1.0):
+        self.resistance = viscosity * grand_resistance_matrix(K, C, Omega)
+        self.mobility = la.inv(self.resistance)
+        self.diffusion = kT * self.mobility
+        self.cholesky = la.cholesky(self.diffusion)
+
+    def __call__(self, dt, n, rotations=None, rng=None):
+        """Return Brownian increments for n particles as an array of shape
+        (n, 6), consisting of the translational displacements and rotation
+        vectors. For stacks of submatrices of shape (m, 3, 3), the shape of
+        the result is (m, n, 6).
+
+        Parameters
+        ----------
+        dt: float
+            Time step
+        n: int
+            Number of particles
+        rotations
+            Optional array of shape (n, 3, 3) (or (m, n, 3, 3) for stacks of
+            submatrices) containing the rotation matrices from the particle
+            frame to the laboratory frame. If given, the increments are
+            returned in the laboratory frame.
+        rng
+            Random number generator providing `standard_normal`, e.g.
+            `np.random.default_rng()`. Defaults to `np.random`.
+        """
+        if rng is None:
+            rng = np.random
+        L = self.cholesky[..., None, :, :]
+        xi = rng.standard_normal(L.shape[:-3] + (n, 6, 1))
+        dX = np.sqrt(2.0 * dt) * np.matmul(L, xi)[..., 0]
+        if rotations is not None:
+            R = np.asarray(rotations, dtype=float)
+            dX = np.concatenate([
+                np.matmul(R, dX[..., :3, None])[..., 0],
+                np.matmul(R, dX[..., 3:, None])[..., 0]], axis=-1)
+        return dX
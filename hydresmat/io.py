@@ -20,9 +20,10 @@
 
 
 import dolfin as dol
+import os
 from hydresmat.common import COMM_WORLD, isOldDolfin
 
-__all__ = ["loadMeshdata", "loadSimdata3", "saveSimdata"]
+__all__ = ["loadMeshdata", "loadSimdata3", "saveSimdata", "saveSimdata3"]
 
 def loadMeshdata(meshpath):
     """Load mesh, subdomains and boundaries from a given HDF5 file.
@@ -58,10 +59,15 @@ def loadSimdata3(paths, mesh):
     rotational motion at once. This process requires information on the
     simulation mesh.
 
+    Instead of three paths, a single path to a file written by `saveSimdata3`
+    can be given. All three simulation results are then read from this file
+    through one (collective) open.
+
     Parameters
     ----------
     paths
-        Array of three paths to load.
+        Array of three paths to load or path (str or path-like object) to a
+        single file containing all three simulation results.
     mesh
         Mesh data from "/mesh" section.
 
@@ -77,8 +83,14 @@ def loadSimdata3(paths, mesh):
     ps = [dol.Function(V) for i in range(3)]
 
     # Reading the solution for all simulations
+    if isinstance(paths, (str, os.PathLike)):
+        with dol.HDF5File(COMM_WORLD, os.fspath(paths), 'r') as fsim:
+            for i, (u, p) in enumerate(zip(us, ps)):
+                fsim.read(u, "/velocity{}".format(i))
+                fsim.read(p, "/pressure{}".format(i))
+        return us,ps
     for path, u, p in zip(paths, us, ps):
-        with dol.HDF5File(COMM_WORLD, path, 'r') as fsim:
+        with dol.HDF5File(COMM_WORLD, os.fspath(path), 'r') as fsim:
             fsim.read(u, "/velocity")
             fsim.read(p, "/pressure")
     return us,ps
@@ -99,3 +111,31 @@ def saveSimdata(savepath, u, p):
     with dol.HDF5File(COMM_WORLD, savepath, 'w') as fsim:
         fsim.write(u, "/velocity")
         fsim.write(p, "/pressure")
+
+def saveSimdata3(savepath, us, ps, chunking=True):
+    """Save three simulation results (e.g. all "rot" or all "trans" runs) in a
+    single file, which can be read by `loadSimdata3`.
+
+    Compared to three files written by `saveSimdata`, this reduces the number
+    of files and the metadata load on parallel file systems. In parallel, the
+    file is written collectively by all processes. If `chunking` is enabled,
+    the datasets are stored chunked, so the file can be compressed afterwards,
+    e.g. with `h5repack -f GZIP=4 in.h5 out.h5`. Compressed files are read
+    transparently by `loadSimdata3`.
+
+    Parameters
+    ----------
+    savepath: str or path-like object
+        Path to file to save
+    us
+        Array of three velocity fields
+    ps
+        Array of three pressure fields
+    chunking: bool, optional
+        Whether to store the datasets chunked
+    """
+    with dol.HDF5File(COMM_WORLD, os.fspath(savepath), 'w') as fsim:
+        fsim.parameters["chunking"] = chunking
+        for i, (u, p) in enumerate(zip(us, ps)):
+            fsim.write(u, "/velocity{}".format(i))
+            fsim.write(p, "/pressure{}".format(i))
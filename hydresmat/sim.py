@@ -27,12 +27,34 @@ __all__ = ["runSimulation"]
 def runSimulation(
     mesh, subdomains, boundaries,
     cube_surface_idxs, particle_surface_idx,
-    particle_bc, kind):
+    particle_bc, kind, matrix_rtol=None, operator="assembled"):
     """Perform HydResMat simulations.
 
     Run a FEM simulation with generated mesh data and particle boundary
     conditions. Both rotational and translational motion can be simulated.
 
+    By default the Krylov solver stops based on the norm of the residual. If
+    `matrix_rtol` is given, the solver additionally monitors the force and
+    torque acting on the particle during the iterations and stops as soon as
+    the estimated relative error of both drops below `matrix_rtol` (see
+    `FunctionalConvergenceTest`), i.e. once the entries of the resulting
+    hydrodynamic resistance matrix have (approximately) reached the requested
+    relative accuracy. This requires petsc4py.
+
+    With `operator="matrix-free"` neither the Stokes operator nor the
+    preconditioner matrix on the mixed space is assembled. Instead, the action
+    of the Stokes operator is assembled in every Krylov iteration (see
+    `StokesAction`) and the preconditioner is block-diagonal (see
+    `StokesPreconditioner`). Only a scalar P2 Laplacian, which has about a
+    ninth of the nonzeros of the velocity block of the mixed matrices, and the
+    lumped pressure mass matrix are stored. This saves most of the memory for
+    matrices and allows larger meshes per node. In exchange, every iteration
+    re-assembles the whole form and applies one AMG cycle to each of the three
+    velocity components, instead of one sparse matrix-vector product and one
+    AMG cycle on the mixed space. How this affects the run time depends on the
+    mesh and the machine, so it should be timed before production runs. This
+    also requires petsc4py.
+
     Parameters
     ----------
     mesh
@@ -49,11 +71,23 @@ def runSimulation(
         Array of three (angular) velocities of the particle
     kind: {"rot", "trans"}
         Type of motion
+    matrix_rtol: float, optional
+        Target relative accuracy of the force and torque on the particle (and
+        thus of the hydrodynamic resistance matrix), e.g. 1e-3 for three
+        significant digits
+    operator: {"assembled", "matrix-free"}, optional
+        Whether to assemble the Stokes operator or to apply it matrix-free
     """
     dol.parameters['ghost_mode'] = 'shared_facet'
     krylov_method = "minres"
     preconditioner = "petsc_amg"
 
+    if operator not in ["assembled", "matrix-free"]:
+        print("Unknown operator mode."
+            "Please use operator = assembled or operator = matrix-free. \n")
+        print(operator)
+        exit()
+
     # Defining the function space for the calculations
     P2 = dol.VectorElement("Lagrange", mesh.ufl_cell(), 2)
     P1 = dol.FiniteElement("Lagrange", mesh.ufl_cell(), 1)
@@ -99,23 +133,373 @@ def runSimulation(
     # Definition for use in constructing the preconditioner matrix
     b = dol.inner(grad(u), grad(v))*dx + p*q*dx
 
-    # Assembling the main system
-    A, bb = dol.assemble_system(a, L, bcs)
+    U = dol.Function(W)
+    if operator == "assembled" and matrix_rtol is None:
+        # Assembling the main system
+        A, bb = dol.assemble_system(a, L, bcs)
 
-    # Assembling the preconditioner system
-    P, btmp = dol.assemble_system(b, L, bcs)
+        # Assembling the preconditioner system
+        P, btmp = dol.assemble_system(b, L, bcs)
 
-    # Creating the Krylov solver and AMG preconditioner
-    solver = dol.KrylovSolver(krylov_method, preconditioner)
+        # Creating the Krylov solver and AMG preconditioner
+        solver = dol.KrylovSolver(krylov_method, preconditioner)
 
-    # Associating the operator A and preconditioner matrix P
-    solver.set_operators(A, P)
+        # Associating the operator A and preconditioner matrix P
+        solver.set_operators(A, P)
 
-    # Computing the solution
-    U = dol.Function(W)
-    solver.solve(U.vector(), bb)
+        # Computing the solution
+        solver.solve(U.vector(), bb)
+    else:
+        # Creating a PETSc Krylov solver, so that the underlying KSP can be
+        # customized via petsc4py
+        if operator == "assembled":
+            solver = dol.PETScKrylovSolver(krylov_method, preconditioner)
+
+            # Assembling the main and the preconditioner system
+            A, bb = dol.assemble_system(a, L, bcs)
+            P, btmp = dol.assemble_system(b, L, bcs)
+            solver.set_operators(
+                dol.as_backend_type(A), dol.as_backend_type(P))
+            X = U
+        else:
+            solver = dol.PETScKrylovSolver(krylov_method, "none")
+
+            # Splitting the solution into a function satisfying the boundary
+            # conditions and a correction with homogeneous boundary values,
+            # which is solved for with the matrix-free operator
+            stokes = StokesAction(a, bcs, W)
+            U, bb = stokes.lift(L, bcs)
+            solver.ksp().setOperators(stokes.createMatrix())
+            StokesPreconditioner(
+                W, boundaries, list(cube_surface_idxs) + [particle_surface_idx]
+            ).attach(solver.ksp())
+            X = dol.Function(W)
+
+        if matrix_rtol is not None:
+            # Replacing the convergence test by one based on the force and
+            # torque acting on the particle
+            functionals = particleFunctionals(
+                W, mesh, boundaries, particle_surface_idx)
+            offsets = [g.inner(U.vector()) for g in functionals] \
+                if X is not U else None
+            solver.ksp().setConvergenceTest(
+                FunctionalConvergenceTest(
+                    [dol.as_backend_type(g).vec() for g in functionals],
+                    matrix_rtol, offsets=offsets))
+
+        # Computing the solution
+        solver.solve(dol.as_backend_type(X.vector()), dol.as_backend_type(bb))
+        if X is not U:
+            U.vector().axpy(1.0, X.vector())
+            U.vector().apply("insert")
 
     # Getting subfunctions
     (u, p) = U.split()
 
     return u,p
+
+def particleFunctionals(W, mesh, boundaries, particle_surface_idx):
+    """Assemble the force and torque on the particle as linear functionals.
+
+    Returns six vectors g, such that the inner product of g with the
+    coefficient vector of a solution on W gives one component of the force
+    (first three vectors) or of the torque (last three vectors) exerted by the
+    flow on the particle. Up to the overall sign, these are the surface
+    integrals evaluated in `calc_submatrices`.
+
+    Parameters
+    ----------
+    W
+        Mixed function space of the simulation
+    mesh
+        Data from the "/mesh" section of the meshfile
+    boundaries
+        Data from the "/boundaries" section of the meshfile
+    particle_surface_idx
+        Index of the particle surface
+    """
+    (v, q) = dol.TestFunctions(W)
+    n = dol.FacetNormal(mesh)
+    r = dol.SpatialCoordinate(mesh)
+    ds = dol.Measure("ds")(domain=mesh, subdomain_data=boundaries)
+
+    # Traction on the particle surface. Since the pressure is simulated with
+    # the wrong sign, it enters the stress tensor with a positive sign.
+    t = q * n + dol.dot(grad(v) + grad(v).T, n)
+    torque = dol.cross(r, t)
+
+    return [dol.assemble(t[i] * ds(particle_surface_idx))
+            for i in range(3)] + \
+           [dol.assemble(torque[i] * ds(particle_surface_idx))
+            for i in range(3)]
+
+class StokesAction(object):
+    """Matrix-free application of the Stokes operator.
+
+    Python context for a PETSc shell matrix (see `createMatrix`), which
+    applies the operator of the bilinear form `a` by assembling its action on
+    the given vector instead of storing the assembled matrix. Like in
+    `dol.assemble_system`, the rows and columns belonging to Dirichlet degrees
+    of freedom are replaced by the identity, so the operator is symmetric and
+    can be used with MINRES. Consequently, it acts on functions with
+    homogeneous boundary values only; the inhomogeneous boundary values are
+    handled by `lift`.
+
+    Parameters
+    ----------
+    a
+        Bilinear form of the Stokes problem
+    bcs
+        List of Dirichlet boundary conditions
+    W
+        Mixed function space of the simulation
+    """
+    def __init__(self, a, bcs, W):
+        self.a = a
+        self.x = dol.Function(W)
+        self.form = dol.action(a, self.x)
+        self.y = dol.Function(W).vector()
+
+        # Homogeneous versions of the boundary conditions
+        self.bcs = [dol.DirichletBC(bc) for bc in bcs]
+        for bc in self.bcs:
+            bc.homogenize()
+
+        # Mask which is zero for all constrained and one for all other degrees
+        # of freedom
+        mask = dol.interpolate(dol.Constant((1.0, 1.0, 1.0, 1.0)), W)
+        for bc in self.bcs:
+            bc.apply(mask.vector())
+        self.mask = dol.as_backend_type(mask.vector()).vec()
+
+    def createMatrix(self):
+        """Return a PETSc shell matrix applying the Stokes operator."""
+        from petsc4py import PETSc
+        x = dol.as_backend_type(self.x.vector()).vec()
+        sizes = x.getSizes()
+        A = PETSc.Mat().createPython((sizes, sizes), self, comm=x.getComm())
+        A.setUp()
+        return A
+
+    def lift(self, L, bcs):
+        """Return a function satisfying the boundary conditions `bcs` together
+        with the right-hand side for the correction to this function.
+
+        Parameters
+        ----------
+        L
+            Linear form of the Stokes problem
+        bcs
+            List of Dirichlet boundary conditions
+        """
+        U0 = dol.Function(self.x.function_space())
+        for bc in bcs:
+            bc.apply(U0.vector())
+        rhs = dol.assemble(L)
+        rhs.axpy(-1.0, dol.assemble(dol.action(self.a, U0)))
+        for bc in self.bcs:
+            bc.apply(rhs)
+        return U0, rhs
+
+    def mult(self, mat, x, y):
+        # Copying x into a function and removing the boundary values
+        xv = dol.as_backend_type(self.x.vector()).vec()
+        x.copy(xv)
+        self.x.vector().apply("insert")
+        for bc in self.bcs:
+            bc.apply(self.x.vector())
+
+        # Assembling the action of the operator
+        dol.assemble(self.form, tensor=self.y)
+
+        # Replacing the constrained entries, i.e. y = mask*(Ax - x) + x
+        Ax = dol.as_backend_type(self.y).vec()
+        Ax.axpy(-1.0, x)
+        y.pointwiseMult(Ax, self.mask)
+        y.axpy(1.0, x)
+
+class StokesPreconditioner(object):
+    """Lightweight block-diagonal preconditioner for the Stokes operator.
+
+    Python context for a PETSc shell preconditioner (see `attach`), which
+    approximates the inverse of the block-diagonal matrix
+    diag(-laplace, mass) without assembling any matrix on the mixed space.
+    The velocity block is treated component-wise with one AMG cycle for the
+    scalar P2 Laplacian, whose nonzeros are about a ninth of those of the
+    vector-valued velocity block. The pressure block is approximated by the
+    inverse of the lumped P1 mass matrix, which is stored as a vector.
+    Dirichlet boundary conditions are imposed on all given surfaces, matching
+    the homogeneous boundary values of `StokesAction`.
+
+    Parameters
+    ----------
+    W
+        Mixed function space of the simulation
+    boundaries
+        Data from the "/boundaries" section of the meshfile
+    surface_idxs
+        Indices of all surfaces with Dirichlet boundary conditions for the
+        velocity
+    """
+    def __init__(self, W, boundaries, surface_idxs):
+        from petsc4py import PETSc
+        mesh = W.mesh()
+        self.w = dol.Function(W)
+        self.w_u = [self.w.sub(0).sub(i) for i in range(3)]
+        self.w_p = self.w.sub(1)
+
+        # Scalar Laplacian for the velocity components
+        S = dol.FunctionSpace(mesh, "CG", 2)
+        s = dol.TrialFunction(S)
+        t = dol.TestFunction(S)
+        zero = dol.Constant(0.0)
+        bcs = [dol.DirichletBC(S, zero, boundaries, idx)
+            for idx in surface_idxs]
+        K, btmp = dol.assemble_system(
+            dol.inner(grad(s), grad(t))*dx, zero*t*dx, bcs)
+        K = dol.as_backend_type(K).mat()
+        self.velocity_pc = PETSc.PC().create(K.getComm())
+        self.velocity_pc.setType("gamg")
+        self.velocity_pc.setOperators(K)
+        self.velocity_pc.setUp()
+        self.u_in = dol.Function(S)
+        self.u_out = dol.Function(S)
+        self.from_w_u = [dol.FunctionAssigner(S, W.sub(0).sub(i))
+            for i in range(3)]
+        self.to_w_u = [dol.FunctionAssigner(W.sub(0).sub(i), S)
+            for i in range(3)]
+
+        # Lumped mass matrix for the pressure
+        Q = dol.FunctionSpace(mesh, "CG", 1)
+        self.p = dol.Function(Q)
+        self.from_w_p = dol.FunctionAssigner(Q, W.sub(1))
+        self.to_w_p = dol.FunctionAssigner(W.sub(1), Q)
+        lumped_mass = dol.assemble(dol.TestFunction(Q)*dx)
+        self.lumped_mass = dol.as_backend_type(lumped_mass).vec()
+
+    def attach(self, ksp):
+        """Use this preconditioner for the given PETSc KSP."""
+        pc = ksp.getPC()
+        pc.setType("python")
+        pc.setPythonContext(self)
+
+    def apply(self, pc, x, y):
+        # Copying x into a function on the mixed space
+        wv = dol.as_backend_type(self.w.vector()).vec()
+        x.copy(wv)
+        self.w.vector().apply("insert")
+
+        # Velocity components
+        for i in range(3):
+            self.from_w_u[i].assign(self.u_in, self.w_u[i])
+            self.velocity_pc.apply(
+                dol.as_backend_type(self.u_in.vector()).vec(),
+                dol.as_backend_type(self.u_out.vector()).vec())
+            self.u_out.vector().apply("insert")
+            self.to_w_u[i].assign(self.w_u[i], self.u_out)
+
+        # Pressure
+        self.from_w_p.assign(self.p, self.w_p)
+        pv = dol.as_backend_type(self.p.vector()).vec()
+        pv.pointwiseDivide(pv, self.lumped_mass)
+        self.p.vector().apply("insert")
+        self.to_w_p.assign(self.w_p, self.p)
+
+        wv.copy(y)
+
+class FunctionalConvergenceTest(object):
+    """Convergence test for a PETSc KSP based on the particle force and torque.
+
+    Every `check_interval` iterations the current iterate is evaluated with the
+    given functionals (see `particleFunctionals`). From the changes of the
+    force and of the torque between successive checks, their contraction
+    factor per check is estimated. Assuming linear convergence, this gives an
+    Aitken-style estimate of the remaining error of force and torque. The
+    solver is considered to be converged when this estimate is smaller than
+    `rtol` times the larger of the magnitudes of force and torque, for both of
+    them. Using a common scale ensures that a force or torque vanishing by
+    symmetry (e.g. the torque on a sphere in a "trans" simulation), whose
+    value is pure discretization noise, does not prevent convergence. The
+    torque is measured in the length unit of the mesh, so this is natural for
+    particles of size of order one, as in the demo. A block whose changes are
+    below a hundredth of the tolerance is considered converged even if it
+    does not contract, since it is then at the noise level.
+
+    In addition, the default residual-based test of PETSc is applied, so the
+    solver also stops when the residual has converged as usual.
+
+    Parameters
+    ----------
+    functionals
+        List of six PETSc vectors representing the force and torque on the
+        particle, or any objects providing `dot`
+    rtol: float
+        Target relative accuracy of the force and of the torque
+    check_interval: int, optional
+        Number of iterations between two evaluations of the functionals
+    offsets
+        Values to add to the functionals, e.g. if the KSP only solves for a
+        correction to a known part of the solution
+    """
+    def __init__(self, functionals, rtol, check_interval=10, offsets=None):
+        self.functionals = functionals
+        self.rtol = rtol
+        self.check_interval = check_interval
+        if offsets is None:
+            offsets = np.zeros(len(functionals))
+        self.offsets = np.asarray(offsets)
+        self.values = None
+        self.changes = None
+        self.rnorm0 = None
+        self.x = None
+
+    def __call__(self, ksp, its, rnorm):
+        from petsc4py import PETSc
+        reason = PETSc.KSP.ConvergedReason
+
+        # Default residual-based convergence test
+        rtol, atol, dtol, max_it = ksp.getTolerances()
+        if not np.isfinite(rnorm):
+            return reason.DIVERGED_NANORINF
+        if its == 0:
+            self.rnorm0 = rnorm
+        if rnorm <= atol:
+            return reason.CONVERGED_ATOL
+        if rnorm <= rtol * self.rnorm0:
+            return reason.CONVERGED_RTOL
+        if its > 0 and rnorm > dtol * self.rnorm0:
+            return reason.DIVERGED_DTOL
+        if its >= max_it:
+            return reason.DIVERGED_ITS
+        if its == 0 or its % self.check_interval != 0:
+            return reason.ITERATING
+
+        # Evaluating the functionals for the current iterate
+        if self.x is None:
+            self.x = ksp.getSolution().duplicate()
+        ksp.buildSolution(self.x)
+        values = np.array([g.dot(self.x) for g in self.functionals]) + \
+            self.offsets
+
+        # Changes of force and torque since the last check
+        previous, self.values = self.values, values
+        if previous is None:
+            return reason.ITERATING
+        blocks = [slice(0, 3), slice(3, 6)]
+        changes = [np.linalg.norm(values[k] - previous[k]) for k in blocks]
+        previous_changes, self.changes = self.changes, changes
+        if previous_changes is None:
+            return reason.ITERATING
+
+        # Estimating the remaining error as change*rho/(1-rho) with the
+        # contraction factor rho = change/previous_change
+        tol = self.rtol * max(np.linalg.norm(values[k]) for k in blocks)
+        for change, previous_change in zip(changes, previous_changes):
+            if max(change, previous_change) < 0.01 * tol:
+                continue
+            if change >= previous_change:
+                return reason.ITERATING
+            error = change**2 / (previous_change - change)
+            if not error < tol:
+                return reason.ITERATING
+        return reason.CONVERGED_RTOL
@@ -0,0 +1,49 @@
+import numpy as np
+
+from hydresmat.brownian import grand_resistance_matrix, BrownianIncrements
+
+# Submatrices of a particle with coupled translation and rotation
+K = np.array([[6.0, 0.5, 0.0], [0.5, 7.0, 0.2], [0.0, 0.2, 8.0]]) * np.pi
+C = np.array([[0.3, 0.0, 0.1], [0.0, -0.2, 0.0], [0.1, 0.0, 0.4]])
+Omega = np.array([[8.0, 0.0, 0.3], [0.0, 9.0, 0.0], [0.3, 0.0, 10.0]]) * np.pi
+
+def rotation_z(phi):
+    c, s = np.cos(phi), np.sin(phi)
+    return np.array([[c, -s, 0.0], [s, c, 0.0], [0.0, 0.0, 1.0]])
+
+def test_grand_resistance_matrix():
+    H = grand_resistance_matrix(K, C, Omega)
+    assert H.shape == (6, 6)
+    assert np.allclose(H[:3, :3], K)
+    assert np.allclose(H[3:, :3], C)
+    assert np.allclose(H[:3, 3:], C.T)
+    assert np.allclose(H[3:, 3:], Omega)
+
+def test_covariance():
+    dt = 0.01
+    increments = BrownianIncrements(K, C, Omega, kT=2.0)
+    H = grand_resistance_matrix(K, C, Omega)
+    assert np.allclose(increments.diffusion, 2.0 * np.linalg.inv(H))
+    dX = increments(dt, 200000, rng=np.random.RandomState(0))
+    assert dX.shape == (200000, 6)
+    assert np.allclose(np.cov(dX.T), 2.0 * dt * increments.diffusion,
+                       atol=2e-5)
+
+def test_rotation():
+    dt = 0.01
+    increments = BrownianIncrements(K, C, Omega)
+    R = rotation_z(0.7)
+    dX = increments(dt, 200000, rotations=np.tile(R, (200000, 1, 1)),
+                    rng=np.random.RandomState(1))
+    RR = np.zeros((6, 6))
+    RR[:3, :3] = RR[3:, 3:] = R
+    assert np.allclose(np.cov(dX.T),
+                       2.0 * dt * RR.dot(increments.diffusion).dot(RR.T),
+                       atol=2e-5)
+
+def test_stacks():
+    increments = BrownianIncrements(
+        np.stack([K, 2.0 * K]), np.stack([C, C]), np.stack([Omega, Omega]))
+    assert increments(0.01, 5).shape == (2, 5, 6)
+    R = np.tile(rotation_z(0.3), (2, 5, 1, 1))
+    assert increments(0.01, 5, rotations=R).shape == (2, 5, 6)
@@ -0,0 +1,218 @@
+import numpy as np
+import pytest
+
+PETSc = pytest.importorskip("petsc4py.PETSc")
+
+from hydresmat.sim import FunctionalConvergenceTest
+
+reason = PETSc.KSP.ConvergedReason
+
+class Functional(object):
+    """Picks one entry of the (stub) solution vector."""
+    def __init__(self, i):
+        self.i = i
+
+    def dot(self, x):
+        return x[self.i]
+
+class Vector(np.ndarray):
+    """Numpy array with the `duplicate` method of a PETSc vector."""
+    def __new__(cls, values):
+        return np.array(values, dtype=float).view(cls)
+
+    def duplicate(self):
+        return Vector(np.zeros(self.shape))
+
+class StubKSP(object):
+    """Minimal KSP, whose iterates converge geometrically to `exact`."""
+    def __init__(self, exact, initial, rho, rtol=1e-12, max_it=10000):
+        self.exact = np.asarray(exact, dtype=float)
+        self.initial = np.asarray(initial, dtype=float)
+        self.rho = rho
+        self.tolerances = (rtol, 1e-50, 1e5, max_it)
+        self.its = 0
+
+    def iterate(self):
+        return self.exact + (self.initial - self.exact) * self.rho**self.its
+
+    def getTolerances(self):
+        return self.tolerances
+
+    def getSolution(self):
+        return Vector(self.iterate())
+
+    def buildSolution(self, x):
+        x[:] = self.iterate()
+
+def solve(ksp, test, rnorm=lambda its: 1.0):
+    for its in range(100000):
+        ksp.its = its
+        result = test(ksp, its, rnorm(its))
+        if result != reason.ITERATING:
+            return result, its
+
+def relative_error(ksp, its):
+    ksp.its = its
+    error = ksp.iterate() - ksp.exact
+    scale = max(np.linalg.norm(ksp.exact[:3]), np.linalg.norm(ksp.exact[3:]))
+    return max(np.linalg.norm(error[:3]), np.linalg.norm(error[3:])) / scale
+
+@pytest.mark.parametrize("rho", [0.9, 0.97, 0.995])
+def test_stops_at_requested_accuracy(rho):
+    rtol = 1e-3
+    ksp = StubKSP([3.0, -1.0, 2.0, 0.5, 0.2, -0.4], np.zeros(6), rho)
+    test = FunctionalConvergenceTest(
+        [Functional(i) for i in range(6)], rtol, check_interval=10)
+    result, its = solve(ksp, test)
+    assert result == reason.CONVERGED_RTOL
+    assert relative_error(ksp, its) < rtol
+    # The previous check must not have been accurate enough yet
+    assert relative_error(ksp, its - 10) >= rtol
+
+def test_vanishing_torque():
+    # Torque vanishing by symmetry, with discretization noise
+    rtol = 1e-3
+    ksp = StubKSP([3.0, -1.0, 2.0, 1e-14, -1e-14, 0.0], np.zeros(6), 0.95)
+    test = FunctionalConvergenceTest(
+        [Functional(i) for i in range(6)], rtol)
+    result, its = solve(ksp, test)
+    assert result == reason.CONVERGED_RTOL
+    assert relative_error(ksp, its) < rtol
+
+def test_offsets():
+    rtol = 1e-3
+    offsets = np.array([1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+    ksp = StubKSP([3.0, -1.0, 2.0, 0.5, 0.2, -0.4], np.zeros(6), 0.95)
+    test = FunctionalConvergenceTest(
+        [Functional(i) for i in range(6)], rtol, offsets=offsets)
+    result, its = solve(ksp, test)
+    assert result == reason.CONVERGED_RTOL
+    assert test.values == pytest.approx(ksp.iterate() + offsets)
+
+def test_residual_fallback():
+    # Residual converges long before the functionals reach the tolerance
+    ksp = StubKSP(np.ones(6), np.zeros(6), 0.999, rtol=1e-6)
+    test = FunctionalConvergenceTest(
+        [Functional(i) for i in range(6)], 1e-10)
+    result, its = solve(ksp, test, rnorm=lambda its: 0.5**its)
+    assert result == reason.CONVERGED_RTOL
+    assert its == 20
+
+def test_max_it():
+    ksp = StubKSP(np.ones(6), np.zeros(6), 0.9999, max_it=50)
+    test = FunctionalConvergenceTest(
+        [Functional(i) for i in range(6)], 1e-10)
+    result, its = solve(ksp, test)
+    assert result == reason.DIVERGED_ITS
+    assert its == 50
+
+def test_nan_residual():
+    ksp = StubKSP(np.ones(6), np.zeros(6), 0.9)
+    test = FunctionalConvergenceTest(
+        [Functional(i) for i in range(6)], 1e-3)
+    result, its = solve(
+        ksp, test, rnorm=lambda its: float("nan") if its == 3 else 1.0)
+    assert result == reason.DIVERGED_NANORINF
+    assert its == 3
+
+# Checks of the matrix-free operator mode on a small cube, where the face x=0
+# plays the role of the particle surface and moves tangentially
+
+CUBE_FACES = ["near(x[0], 0.0)", "near(x[0], 1.0)", "near(x[1], 0.0)",
+              "near(x[1], 1.0)", "near(x[2], 0.0)", "near(x[2], 1.0)"]
+PARTICLE_IDX = 1
+CUBE_IDXS = [2, 3, 4, 5, 6]
+PARTICLE_BC = np.array([0.0, 1.0, 0.0])
+
+@pytest.fixture(scope="module")
+def cube():
+    import dolfin as dol
+    mesh = dol.UnitCubeMesh(4, 4, 4)
+    subdomains = dol.MeshFunction("size_t", mesh, 3)
+    subdomains.set_all(0)
+    boundaries = dol.MeshFunction("size_t", mesh, 2)
+    boundaries.set_all(0)
+    for i, face in enumerate(CUBE_FACES):
+        dol.CompiledSubDomain(face + " && on_boundary").mark(boundaries, i+1)
+    return mesh, subdomains, boundaries
+
+def stokes_problem(mesh, boundaries):
+    import dolfin as dol
+    from dolfin import grad, div, dx
+    P2 = dol.VectorElement("Lagrange", mesh.ufl_cell(), 2)
+    P1 = dol.FiniteElement("Lagrange", mesh.ufl_cell(), 1)
+    W = dol.FunctionSpace(mesh, P2 * P1)
+    bcs = [dol.DirichletBC(W.sub(0), dol.Constant((0.0, 0.0, 0.0)),
+                           boundaries, idx) for idx in CUBE_IDXS]
+    bcs.append(dol.DirichletBC(W.sub(0), dol.Constant(tuple(PARTICLE_BC)),
+                               boundaries, PARTICLE_IDX))
+    (u, p) = dol.TrialFunctions(W)
+    (v, q) = dol.TestFunctions(W)
+    a = dol.inner(grad(u), grad(v))*dx + div(v) * p * dx + q * div(u) * dx
+    L = dol.inner(dol.Constant((0.0, 0.0, 0.0)), v) * dx
+    return W, bcs, a, L
+
+def test_shell_matches_assembled(cube):
+    import dolfin as dol
+    from hydresmat.sim import StokesAction
+    mesh, subdomains, boundaries = cube
+    W, bcs, a, L = stokes_problem(mesh, boundaries)
+    A, bb = dol.assemble_system(a, L, bcs)
+    A = dol.as_backend_type(A).mat()
+    stokes = StokesAction(a, bcs, W)
+
+    # Operator
+    x = dol.as_backend_type(dol.Function(W).vector()).vec()
+    x.setRandom()
+    y_assembled = x.duplicate()
+    y_shell = x.duplicate()
+    A.mult(x, y_assembled)
+    stokes.createMatrix().mult(x, y_shell)
+    y_shell.axpy(-1.0, y_assembled)
+    assert y_shell.norm() <= 1e-10 * y_assembled.norm()
+
+    # Lifting, i.e. A*U0 + rhs has to equal the assembled right-hand side
+    U0, rhs = stokes.lift(L, bcs)
+    y = x.duplicate()
+    A.mult(dol.as_backend_type(U0.vector()).vec(), y)
+    y.axpy(1.0, dol.as_backend_type(rhs).vec())
+    bb = dol.as_backend_type(bb).vec()
+    y.axpy(-1.0, bb)
+    assert y.norm() <= 1e-10 * bb.norm()
+
+def test_matrix_free_matches_assembled(cube, monkeypatch):
+    import dolfin as dol
+    from dolfin import dx
+    from hydresmat.sim import runSimulation, StokesAction, \
+        StokesPreconditioner
+    mesh, subdomains, boundaries = cube
+
+    # Counting operator and preconditioner applications
+    counts = {"mult": 0, "apply": 0}
+    def counted(name, method):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return method(*args, **kwargs)
+        return wrapper
+    monkeypatch.setattr(
+        StokesAction, "mult", counted("mult", StokesAction.mult))
+    monkeypatch.setattr(
+        StokesPreconditioner, "apply",
+        counted("apply", StokesPreconditioner.apply))
+
+    u_a, p_a = runSimulation(mesh, subdomains, boundaries, CUBE_IDXS,
+                             PARTICLE_IDX, PARTICLE_BC, "trans")
+    u_m, p_m = runSimulation(mesh, subdomains, boundaries, CUBE_IDXS,
+                             PARTICLE_IDX, PARTICLE_BC, "trans",
+                             operator="matrix-free")
+
+    # One operator and one preconditioner application per iteration
+    assert counts["mult"] > 0
+    assert abs(counts["mult"] - counts["apply"]) <= 1
+
+    # Velocities agree within the solver tolerance, pressures up to a
+    # constant, since the pressure is only determined up to a constant here
+    norm = lambda f: np.sqrt(dol.assemble(dol.inner(f, f) * dx))
+    assert norm(u_a - u_m) <= 1e-3 * norm(u_a)
+    dp = p_a - p_m - dol.assemble((p_a - p_m) * dx)
+    assert norm(dp) <= 1e-2 * norm(p_a - dol.assemble(p_a * dx))